@@ -4,9 +4,13 @@ __copyright__ = "Copyright (C) 2014 Ivan D Vasin"
 __docformat__ = "restructuredtext"
 
 import abc as _abc
+from collections import OrderedDict as _OrderedDict
+from contextlib import contextmanager as _contextmanager
 import os as _os
 import re as _re
 import signal as _signal
+import threading as _threading
+from time import time as _time
 
 import ldap as _ldap
 import psutil as _ps
@@ -27,9 +31,10 @@ class Service(object):
     chosen implementation, which is a :class:`ServiceImpl` subclass.
 
     To instantiate a service using any available implementation, omit
-    *impl*.  To instantiate a service using a particular implementation,
+    *impl*; the first available implementation, in order of registration,
+    is used.  To instantiate a service using a particular implementation,
     provide a registered *impl* name.  To register a new implementation, use
-    :meth:`register_impl`.
+    :meth:`register_impl` or :meth:`register_impl_loader`.
 
     These implementations are available by default if their corresponding
     dependencies are met:
@@ -53,29 +58,29 @@ class Service(object):
 
     def __init__(self, uris, configloc, impl=None, pid=None, stop_on_del=True,
                  **kwargs):
-        self.__dict__['_impl'] = \
-            self.impl_class(impl)(uris=uris, configloc=configloc, pid=pid,
-                                  stop_on_del=stop_on_del, **kwargs)
+        impl = self.impl_class(impl)(uris=uris, configloc=configloc, pid=pid,
+                                     stop_on_del=stop_on_del, **kwargs)
+        self.__dict__['_impl'] = impl
+        self.__dict__['_impl_attrs'] = frozenset(dir(impl))
 
     def __getattr__(self, name):
-        try:
-            return getattr(self.impl, name)
-        except AttributeError as exc:
-            try:
-                return object.__getattr__(self, name)
-            except AttributeError:
-                raise exc
+        return getattr(self.impl, name)
 
     def __setattr__(self, name, value):
-        if hasattr(self.impl, name):
-            setattr(self.impl, name, value)
+        # CAVEAT: avoid :func:`hasattr`, which would evaluate the
+        #     implementation's properties
+        impl = self.impl
+        if name in self._impl_attrs \
+               or name in getattr(impl, '__dict__', ()):
+            setattr(impl, name, value)
         else:
             object.__setattr__(self, name, value)
 
     @classmethod
     def create_basic(cls, uris, configloc, schemas, modules, config_password,
                      dbtype, dbdir, suffix, root_dn, root_password, impl=None,
-                     authz_map=None, access=(), index=(), pidfile=None):
+                     authz_map=None, access=(), index=(), pidfile=None,
+                     dbconfig=()):
         return cls.impl_class(impl)\
                   .create_basic(uris=uris,
                                 configloc=configloc,
@@ -90,7 +95,8 @@ class Service(object):
                                 authz_map=authz_map,
                                 access=access,
                                 index=index,
-                                pidfile=pidfile)
+                                pidfile=pidfile,
+                                dbconfig=dbconfig)
 
     @property
     def impl(self):
@@ -104,11 +110,16 @@ class Service(object):
     @classmethod
     def impl_class(cls, name=None):
         if name is None:
-            try:
-                name = cls._impls.keys()[0]
-            except IndexError:
+            for name in cls._impl_order:
+                if name not in cls._impls:
+                    cls._load_impl(name)
+                if name in cls._impls:
+                    break
+            else:
                 raise RuntimeError('cannot find any implementations of {}.{}'
                                     .format(cls.__module__, cls.__name__))
+        elif name not in cls._impls:
+            cls._load_impl(name)
         return cls._impls[name]
 
     @classmethod
@@ -123,9 +134,55 @@ class Service(object):
         :type impl: :class:`ServiceImpl`
 
         """
-        cls._impls[name] = impl
+        with cls._impls_lock:
+            cls._impl_loaders.pop(name, None)
+            cls._impls[name] = impl
+            if name not in cls._impl_order:
+                cls._impl_order.append(name)
+
+    @classmethod
+    def register_impl_loader(cls, name, loader):
+        """Register a loader for an LDAP service implementation.
+
+        This defers the implementation's discovery, such as probing for its
+        dependencies, until the implementation is first requested via
+        :meth:`impl_class`.  At that time, *loader* is called with no
+        arguments.  It returns the implementation, or null if the
+        implementation is unavailable in the current environment.
+
+        :param str name:
+            The implementation's name.
+
+        :param loader:
+            The implementation's loader.
+        :type loader: :obj:`callable`
+
+        """
+        with cls._impls_lock:
+            cls._impl_loaders[name] = loader
+            if name not in cls._impl_order:
+                cls._impl_order.append(name)
 
-    _impls = {}
+    @classmethod
+    def _load_impl(cls, name):
+        with cls._impls_lock:
+            loader = cls._impl_loaders.pop(name, None)
+            if loader is not None:
+                impl = loader()
+                if impl is not None:
+                    cls._impls[name] = impl
+
+    _impl = None
+
+    _impl_attrs = frozenset()
+
+    _impl_loaders = {}
+
+    _impl_order = []
+
+    _impls = _OrderedDict()
+
+    _impls_lock = _threading.RLock()
 
 
 class ServiceImpl(object):
@@ -142,6 +199,7 @@ class ServiceImpl(object):
 
     def __init__(self, uris, configloc, pid=None, stop_on_del=True):
 
+        self._client_pool = {}
         self._configloc = configloc
         self.stop_on_del = stop_on_del
         self._uris = tuple(uris)
@@ -161,17 +219,76 @@ class ServiceImpl(object):
         if stop:
             self.stop()
 
-    def client(self):
+    @_contextmanager
+    def bound_client(self, bind_dn, password):
+        """A context that provides a pooled client bound as some DN.
 
-        chosen_uri = None
-        for uri in self.uris:
-            if uri.lower().startswith('ldapi:'):
-                chosen_uri = uri
-                break
-        if not chosen_uri:
-            chosen_uri = self.uris[0]
+        If the context exits with an exception, then the client is discarded
+        instead of being kept in the pool, since its connection might no
+        longer be usable.
+
+        .. seealso:: :meth:`client`
+
+        :param str bind_dn:
+            The DN as which to bind.
 
-        return _ldap.initialize(chosen_uri)
+        :param str password:
+            The password with which to bind.
+
+        """
+        client = self.client(bind_dn, password)
+        try:
+            yield client
+        except Exception:
+            self._discard_client(bind_dn, password)
+            raise
+
+    def client(self, bind_dn=None, password=None):
+        """A client connection to this service.
+
+        If *bind_dn* is null, then this returns a new unbound connection.
+        Otherwise, it returns a pooled connection that is bound as
+        *bind_dn* with *password*, binding a new one if none is pooled yet.
+        Pooled connections are unbound by :meth:`close_clients`, which is
+        called whenever this service stops running.
+
+        :param bind_dn:
+            The DN as which to bind.
+        :type bind_dn: :obj:`str` or null
+
+        :param password:
+            The password with which to bind.
+        :type password: :obj:`str` or null
+
+        :rtype: :class:`ldap.ldapobject.LDAPObject`
+
+        """
+
+        uri = self._client_uri()
+
+        if bind_dn is None:
+            return _ldap.initialize(uri)
+
+        # the password is part of the key, so that a bind with the wrong
+        # password still fails rather than reusing a connection
+        key = (uri, bind_dn, password)
+        try:
+            return self._client_pool[key]
+        except KeyError:
+            client = _ldap.initialize(uri)
+            client.simple_bind_s(bind_dn, password)
+            self._client_pool[key] = client
+            return client
+
+    def close_clients(self):
+        """Unbind and discard all pooled client connections."""
+        client_pool = self._client_pool
+        self._client_pool = {}
+        for client in client_pool.values():
+            try:
+                client.unbind_s()
+            except _ldap.LDAPError:
+                pass
 
     @property
     def configloc(self):
@@ -181,7 +298,8 @@ class ServiceImpl(object):
     @_abc.abstractmethod
     def create_basic(cls, uris, configloc, schemas, modules, config_password,
                      dbtype, dbdir, suffix, root_dn, root_password,
-                     authz_map=None, access=(), index=(), pidfile=None):
+                     authz_map=None, access=(), index=(), pidfile=None,
+                     dbconfig=()):
         pass
 
     @property
@@ -190,7 +308,9 @@ class ServiceImpl(object):
 
     def start(self, fork=False):
 
-        if self.status == 'running':
+        # a status reused from a recent probe might be stale
+        self._probe_status(fresh=True)
+        if self._status == 'running':
             raise _exc.InvalidServiceOperation\
                    (self, 'start', 'the service is already running')
 
@@ -203,10 +323,16 @@ class ServiceImpl(object):
 
     def stop(self):
 
-        if self.status != 'running':
+        # a service that died recently might not be reaped yet, in which
+        # case signalling it would succeed; so the status is probed afresh,
+        # which reaps it
+        self._probe_status(fresh=True)
+        if self._status != 'running':
             raise _exc.InvalidServiceOperation(self, 'stop',
                                                'the service is not running')
 
+        self.close_clients()
+
         try:
             _os.kill(self.pid, _signal.SIGTERM)
         except OSError as exc:
@@ -219,7 +345,12 @@ class ServiceImpl(object):
                 raise
         else:
             self._slapd_proc.poll()
-            _os.waitpid(self.pid, 0)
+            try:
+                _os.waitpid(self.pid, 0)
+            except OSError as exc:
+                # the service exited quickly enough to be reaped above
+                if exc.errno != _os.errno.ECHILD:
+                    raise
             self._set_status('stopped')
 
     @property
@@ -234,15 +365,54 @@ class ServiceImpl(object):
     def uris(self):
         return self._uris
 
-    def _probe_status(self):
+    def _client_uri(self):
+        for uri in self.uris:
+            if uri.lower().startswith('ldapi:'):
+                return uri
+        return self.uris[0]
+
+    def _discard_client(self, bind_dn, password):
+        key = (self._client_uri(), bind_dn, password)
+        client = self._client_pool.pop(key, None)
+        if client is not None:
+            try:
+                client.unbind_s()
+            except _ldap.LDAPError:
+                pass
+
+    @staticmethod
+    def _parse_suffix_org_dn(dn):
+        # equivalent to matching _SUFFIX_ORG_DN_RE, which remains the
+        # reference pattern for error messages
+        rdns = dn.split(',')
+        if len(rdns) != 2 \
+               or not all(rdn.startswith('dc=') for rdn in rdns):
+            raise ValueError('invalid organization DN {!r}; expected one that'
+                              ' matches {!r}'
+                              .format(dn,
+                                      ServiceImpl._SUFFIX_ORG_DN_RE.pattern))
+        org_rdn, tld_rdn = rdns
+        return org_rdn[3:], tld_rdn[3:]
+
+    def _probe_status(self, fresh=False):
         if self._status == 'running':
-            gone = False
-            if _ps.pid_exists(self.pid):
-                if _ps.Process(self.pid).status == _ps.STATUS_ZOMBIE:
-                    gone = True
-                    _os.waitpid(self.pid, 0)
+            now = _time()
+            since_probe = now - self._status_probed_at
+            if not fresh and 0 <= since_probe < self._STATUS_PROBE_TTL:
+                return
+            self._status_probed_at = now
+
+            try:
+                pid, _ = _os.waitpid(self.pid, _os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != _os.errno.ECHILD:
+                    raise
+                # the service is not our child, so we cannot reap it; consult
+                # the process table instead
+                gone = not _ps.pid_exists(self.pid) \
+                       or _ps.Process(self.pid).status == _ps.STATUS_ZOMBIE
             else:
-                gone = True
+                gone = pid != 0
             if gone:
                 self._set_status('gone')
 
@@ -259,6 +429,11 @@ class ServiceImpl(object):
 
         self._pid = pid
         self._status = status
+        self._status_probed_at = 0.
+
+        # the connections to a service that is no longer running are dead
+        if status != 'running':
+            self.close_clients()
 
         if pid is not None:
             self._probe_status()
@@ -278,6 +453,13 @@ class ServiceImpl(object):
     def _start_nofork(self):
         pass
 
+    _STATUS_PROBE_TTL = 0.05
+    """
+    The time, in seconds, for which the result of probing a running
+    service's status is reused.
+
+    """
+
     _SUFFIX_ORG_DN_RE = _re.compile(r'^dc=(?P<org>[^,]*),dc=(?P<tld>[^,]*)$')
 
 
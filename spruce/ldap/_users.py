@@ -10,12 +10,16 @@ class InetOrgPerson(_namedtuple('InetOrgPerson',
                                 ('commonname', 'displayname', 'givenname',
                                  'name', 'password', 'surname'))):
 
+    __slots__ = ()
+
     def __repr__(self):
-        return '{}(name={}, displayname={}, commonname={}, givenname={},'\
-                ' surname={}, password={})'\
-                .format(self.__class__.__name__, self.name, self.displayname,
-                        self.commonname, self.givenname, self.surname,
-                        self.password)
+        return self._REPR_FORMAT % (self.__class__.__name__, self.name,
+                                    self.displayname, self.commonname,
+                                    self.givenname, self.surname,
+                                    self.password)
 
     def __str__(self):
         return self.name
+
+    _REPR_FORMAT = '%s(name=%s, displayname=%s, commonname=%s, givenname=%s,'\
+                    ' surname=%s, password=%s)'
@@ -3,6 +3,10 @@
 These objects provide support for service implementations based on
 `OpenLDAP <http://www.openldap.org/>`_.
 
+The ``openldap`` :class:`~spruce.ldap._services.Service` implementation is
+registered lazily: the environment is probed for OpenLDAP's
+:command:`slapd` only when the implementation is first requested.
+
 """
 
 __copyright__ = "Copyright (C) 2014 Ivan D Vasin"
@@ -13,13 +17,22 @@ import subprocess as _subprocess
 
 import pkg_resources as _pkg_resources
 
-try:
-    _pkg_resources.require('spruce-ldap [openldap]')
-except _pkg_resources.ResolutionError:
-    pass
-else:
-    for searchpath in _os.environ['PATH'].split(_os.pathsep):
+from .._services import Service as _Service
+from ._services import *
+
+
+def _load_service_impl():
+
+    try:
+        _pkg_resources.require('spruce-ldap [openldap]')
+    except _pkg_resources.ResolutionError:
+        return None
+
+    for searchpath in _os.environ.get('PATH', _os.defpath).split(_os.pathsep):
         slapd_path = _os.path.join(searchpath.strip('"'), 'slapd')
+        if not (_os.path.isfile(slapd_path)
+                and _os.access(slapd_path, _os.X_OK)):
+            continue
         try:
             slapd_output = _subprocess.check_output((slapd_path, '-VV'),
                                                     stderr=_subprocess.STDOUT)
@@ -29,5 +42,9 @@ else:
             slapd_output = exc.output
 
         if 'openldap' in slapd_output.lower():
-            from ._services import *
+            return OpenLdapService
         break
+
+    return None
+
+_Service.register_impl_loader('openldap', _load_service_impl)
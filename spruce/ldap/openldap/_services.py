@@ -5,19 +5,21 @@ __docformat__ = "restructuredtext"
 
 from base64 import b64encode as _b64encode
 from hashlib import sha1 as _sha1
+import fcntl as _fcntl
 import logging as _logging
 import os as _os
 import re as _re
+import select as _select
 from pipes import quote as _shquote
 import subprocess as _subprocess
 import sys as _sys
-from tempfile import NamedTemporaryFile as _NamedTemporaryFile
+from tempfile import mkstemp as _mkstemp
 from time import sleep as _sleep, time as _time
 
 import ldap as _ldap
 from spruce.pprint import indented as _indented
 
-from .. import _services
+from .. import _exc, _services
 
 
 class OpenLdapService(_services.ServiceImpl):
@@ -27,34 +29,34 @@ class OpenLdapService(_services.ServiceImpl):
     @classmethod
     def create_basic(cls, uris, configloc, schemas, modules, config_password,
                      dbtype, dbdir, suffix, root_dn, root_password,
-                     authz_map=None, access=(), index=(), pidfile=None):
+                     authz_map=None, access=(), index=(), pidfile=None,
+                     dbconfig=()):
 
         suffix_rdns = suffix.split(',')
         if len(suffix_rdns) > 1:
             suffix_org_dn = ','.join(suffix_rdns[-2:])
             suffix_orgunits_rdns = suffix_rdns[:-2]
 
-            suffix_org_dn_match = cls._SUFFIX_ORG_DN_RE.match(suffix_org_dn)
-            if not suffix_org_dn_match:
+            try:
+                suffix_org, _ = cls._parse_suffix_org_dn(suffix_org_dn)
+            except ValueError:
                 raise ValueError('invalid suffix DN {!r}; expected one in'
                                   ' which the last two components match {!r}'
-                                  .format(suffix, cls._SUFFIX_ORG_DN_RE))
-            suffix_org = suffix_org_dn_match.group('org')
+                                  .format(suffix,
+                                          cls._SUFFIX_ORG_DN_RE.pattern))
 
-        if cls._PASSWORD_WITH_SCHEME_RE.match(root_password):
+        if cls._password_has_scheme(root_password):
             root_password_configvalue = root_password
         else:
-            root_password_salt = _os.urandom(4)
-            root_password_configvalue = \
-                '{SSHA}' + _b64encode(_sha1(root_password + root_password_salt)
-                                       .digest()
-                                      + root_password_salt)
+            root_password_configvalue = cls._ssha_hash(root_password)
 
         authz_map = authz_map or {}
         try:
-            authz_map_items = authz_map.items()
+            authz_map_items = authz_map.iteritems()
         except AttributeError:
             authz_map_items = authz_map
+        authz_regexps = ['{} {}'.format(match, replacement)
+                         for match, replacement in authz_map_items]
 
         service = cls.create_minimal(uris=uris,
                                      configloc=configloc,
@@ -66,68 +68,77 @@ class OpenLdapService(_services.ServiceImpl):
             _sys.exit()
 
         try:
-            config_client = service.client()
-            config_client.simple_bind_s('cn=config', config_password)
-
-            # configure SASL authentication
-            config_client\
-             .modify_s('cn=config',
-                       ((_ldap.MOD_REPLACE, 'olcPasswordHash', '{CLEARTEXT}'),
-                        (_ldap.MOD_REPLACE, 'olcAuthzRegexp',
-                         tuple('{} {}'.format(match, replacement)
-                               for match, replacement in authz_map_items)),
-                        ))
-
-            # configure primary backend database
-            config_client\
-             .add_s('cn=Module{0},cn=config',
-                    (('objectClass', 'olcModuleList'),
-                     ('olcModuleLoad', modules)))
-            config_client\
-             .add_s('olcDatabase={},cn=config'.format(dbtype),
-                    (('objectClass',
+            with service.bound_client('cn=config', config_password) \
+                     as config_client:
+
+                # configure SASL authentication and load the backend modules
+                config_msgids = \
+                    (config_client
+                      .modify('cn=config',
+                              ((_ldap.MOD_REPLACE, 'olcPasswordHash',
+                                '{CLEARTEXT}'),
+                               (_ldap.MOD_REPLACE, 'olcAuthzRegexp',
+                                authz_regexps),
+                               )),
+                     config_client
+                      .add('cn=Module{0},cn=config',
+                           (('objectClass', 'olcModuleList'),
+                            ('olcModuleLoad', modules))),
+                     )
+                for msgid in config_msgids:
+                    config_client.result(msgid)
+
+                # configure primary backend database; this depends on its
+                # backend module, so it must wait for the requests above
+                database_attrs = \
+                    [('objectClass',
                       'olc{}Config'.format(dbtype.capitalize())),
                      ('olcDatabase', dbtype),
                      ('olcDbDirectory', dbdir),
                      ('olcSuffix', suffix),
                      ('olcRootDN', root_dn),
                      ('olcRootPW', root_password_configvalue),
-                     ))
-            config_client\
-             .modify_s('olcDatabase={1}hdb,cn=config',
-                       ((_ldap.MOD_ADD, 'olcDbIndex', index),
-                        (_ldap.MOD_REPLACE, 'olcAccess', access)))
-
-            config_client.unbind_s()
+                     ]
+                if index:
+                    database_attrs.append(('olcDbIndex', index))
+                if access:
+                    database_attrs.append(('olcAccess', access))
+                # any additional backend-specific settings, such as
+                # ('olcDbNoSync', 'TRUE')
+                database_attrs.extend(dbconfig)
+                config_client.add_s('olcDatabase={},cn=config'.format(dbtype),
+                                    database_attrs)
 
             # initialize suffix
-            suffix_rdns = suffix.split(',')
             if len(suffix_rdns) > 1:
 
-                root_client = service.client()
-                root_client.simple_bind_s(root_dn, root_password)
-
-                root_client\
-                 .add_s(suffix_org_dn,
-                        (('objectClass', ('dcObject', 'organization')),
-                         ('dc', suffix_org), ('o', suffix_org)))
-
-                orgunit_dn = suffix_org_dn
-                for orgunit_rdn in suffix_orgunits_rdns:
-                    orgunit_dn = ','.join(orgunit_rdn, orgunit_dn)
-
-                    _, orgunit = orgunit_dn.split('=')
-                    root_client\
-                     .add_s(suffix_org_dn,
-                            (('objectClass', 'dcObject'),
-                             ('objectClass', 'organizationalUnit'),
-                             ('dc', orgunit), ('ou', orgunit)))
-
-                root_client.unbind_s()
+                with service.bound_client(root_dn, root_password) \
+                         as root_client:
+
+                    # only the suffix entry itself is in the database's
+                    # naming context; its ancestors, if any, are not
+                    if suffix_orgunits_rdns:
+                        _, orgunit = suffix_orgunits_rdns[0].split('=', 1)
+                        root_client\
+                         .add_s(suffix,
+                                (('objectClass', 'dcObject'),
+                                 ('objectClass', 'organizationalUnit'),
+                                 ('dc', orgunit), ('ou', orgunit)))
+                    else:
+                        root_client\
+                         .add_s(suffix_org_dn,
+                                (('objectClass',
+                                  ('dcObject', 'organization')),
+                                 ('dc', suffix_org), ('o', suffix_org)))
 
         finally:
+            # if slapd died, then stopping it fails; that must not hide the
+            # error that is propagating from the configuration above
             if service.status == _services.ServiceStatus('running'):
-                service.stop()
+                try:
+                    service.stop()
+                except _exc.InvalidServiceOperation:
+                    pass
 
         return service
 
@@ -144,8 +155,9 @@ class OpenLdapService(_services.ServiceImpl):
                                 ' exit code {} with output\n{}'
                                 .format(configfile, exc.returncode,
                                         _indented(exc.output)))
-        for line in slaptest_output.split('\n'):
-            _logging.debug('slaptest: ' + line)
+        if _logging.getLogger().isEnabledFor(_logging.DEBUG):
+            for line in slaptest_output.splitlines():
+                _logging.debug('slaptest: ' + line)
 
         return cls(uris, configloc=configdir)
 
@@ -166,15 +178,10 @@ class OpenLdapService(_services.ServiceImpl):
                               ' directory path'
                               .format(configloc))
 
-        if cls._PASSWORD_WITH_SCHEME_RE.match(config_password):
+        if cls._password_has_scheme(config_password):
             config_password_configvalue = config_password
         else:
-            config_password_salt = _os.urandom(4)
-            config_password_configvalue = \
-                '{SSHA}' + _b64encode(_sha1(config_password
-                                            + config_password_salt)
-                                       .digest()
-                                      + config_password_salt)
+            config_password_configvalue = cls._ssha_hash(config_password)
 
         if not pidfile:
             if _os.path.isdir(cls._PIDFILE_STD_DIR) \
@@ -182,37 +189,55 @@ class OpenLdapService(_services.ServiceImpl):
                 pidfile_dir = cls._PIDFILE_STD_DIR
             else:
                 pidfile_dir = None
-            pidfile_tmp = _NamedTemporaryFile(dir=pidfile_dir, prefix='slapd-',
-                                              suffix='.pid')
-            with pidfile_tmp:
-                pass
-            pidfile = pidfile_tmp.name
-
-        configfile = _NamedTemporaryFile(delete=False)
-        with configfile:
-            for schema in schemas:
-                configfile.write('include {}\n'.format(schema))
-            configfile.write('pidfile {}\n'.format(pidfile))
-            configfile.write('database config\n')
-            configfile.write('rootpw {}\n'.format(config_password_configvalue))
-
-        service = cls.create_from_configfile(uris=uris,
-                                             configfile=configfile.name,
-                                             configdir=configloc)
-        _os.remove(configfile.name)
-        return service
+            # reserve a unique name; slapd creates the file itself
+            pidfile_fd, pidfile = _mkstemp(dir=pidfile_dir, prefix='slapd-',
+                                           suffix='.pid')
+            _os.close(pidfile_fd)
+            _os.remove(pidfile)
+
+        config = ''.join(['include {}\n'.format(schema)
+                          for schema in schemas]
+                         + ['pidfile {}\n'.format(pidfile),
+                            'database config\n',
+                            'rootpw {}\n'.format(config_password_configvalue),
+                            ])
+
+        configfile_fd, configfile_path = _mkstemp()
+        try:
+            with _os.fdopen(configfile_fd, 'w') as configfile:
+                configfile.write(config)
+
+            return cls.create_from_configfile(uris=uris,
+                                              configfile=configfile_path,
+                                              configdir=configloc)
+        finally:
+            _os.remove(configfile_path)
+
+    @classmethod
+    def _password_has_scheme(cls, password):
+        # most passwords have no scheme, so avoid the regex for those
+        return password.startswith('{') \
+               and cls._PASSWORD_WITH_SCHEME_RE.match(password) is not None
+
+    @staticmethod
+    def _ssha_hash(password):
+        salt = _os.urandom(4)
+        hasher = _sha1(password)
+        hasher.update(salt)
+        return '{SSHA}' + _b64encode(hasher.digest() + salt)
 
     def _start(self, fork=False):
 
         pidfilepath = None
-        with open(_os.path.join(self.configloc, 'cn=config.ldif'), 'r') \
+        with open(_os.path.join(self.configloc, 'cn=config.ldif'), 'rb') \
                  as config_ldif:
-            for line in config_ldif.readlines():
-                match = _re.match(r'olcPidFile:\s+(?P<pidfile>.*)\n', line)
+            for line in config_ldif:
+                match = self._OLC_PIDFILE_RE.match(line)
                 if match:
                     pidfilepath = match.group('pidfile')
                     break
 
+        debug = _logging.getLogger().isEnabledFor(_logging.DEBUG)
         slapd_args = \
             ('slapd',
              '-h',
@@ -220,20 +245,51 @@ class OpenLdapService(_services.ServiceImpl):
              '-F',
              self.configloc,
              '-d',
-             '239' if _logging.getLogger().isEnabledFor(_logging.DEBUG)
-                   else '32768')
+             '239' if debug else '32768')
 
         if fork:
             slapd_proc = _subprocess.Popen(slapd_args, stdout=_subprocess.PIPE,
                                            stderr=_subprocess.STDOUT,
                                            close_fds=True)
             self._slapd_proc = slapd_proc
+
+            # wait for slapd to announce that it has started; if it exits
+            # first, the pipe hangs up and wakes the same poll
+            slapd_output_fd = slapd_proc.stdout.fileno()
+            _fcntl.fcntl(slapd_output_fd, _fcntl.F_SETFL,
+                         _fcntl.fcntl(slapd_output_fd, _fcntl.F_GETFL)
+                         | _os.O_NONBLOCK)
+            slapd_output_poller = _select.poll()
+            slapd_output_poller.register(slapd_output_fd,
+                                         _select.POLLIN | _select.POLLPRI)
             slapd_output = ''
-            slapd_started = False
-            while not slapd_started:
-                slapd_proc.poll()
-                if slapd_proc.returncode is not None:
-                    slapd_output += slapd_proc.stdout.read()
+            slapd_output_logged_end = 0
+            start_deadline = _time() + self._START_TIMEOUT
+            while True:
+                timeout = start_deadline - _time()
+                if timeout <= 0:
+                    slapd_proc.kill()
+                    slapd_proc.wait()
+                    raise RuntimeError('cannot start OpenLDAP service via'
+                                        ' {!r}: slapd did not start within'
+                                        ' {} seconds; output\n{}'
+                                        .format(' '.join(_shquote(arg)
+                                                         for arg
+                                                         in slapd_args),
+                                                self._START_TIMEOUT,
+                                                slapd_output))
+
+                if not slapd_output_poller.poll(max(int(timeout * 1000), 1)):
+                    continue
+
+                try:
+                    chunk = _os.read(slapd_output_fd, self._OUTPUT_READ_SIZE)
+                except OSError as exc:
+                    if exc.errno == _os.errno.EAGAIN:
+                        continue
+                    raise
+                if not chunk:
+                    slapd_proc.wait()
                     raise RuntimeError('cannot start OpenLDAP service via'
                                         ' {!r}: slapd returned exit code {}'
                                         ' with output\n{}'
@@ -243,22 +299,30 @@ class OpenLdapService(_services.ServiceImpl):
                                                 slapd_proc.returncode,
                                                 slapd_output))
 
-                current_poll_period_starttime = _time()
-                while _time() - current_poll_period_starttime \
-                      < self._START_POLL_PERIOD:
-                    line = slapd_proc.stdout.readline()
-                    slapd_output += line
-                    _logging.debug('slapd: ' + line.rstrip('\n'))
-
-                    if 'slapd starting' in line:
-                        slapd_started = True
-                        slapd_proc.stdout.close()
-                        break
+                # the start message may straddle two chunks
+                search_start = max(len(slapd_output)
+                                    - len(self._START_MESSAGE) + 1,
+                                   0)
+                slapd_output += chunk
+                started = \
+                    slapd_output.find(self._START_MESSAGE, search_start) >= 0
+
+                if debug:
+                    # log complete lines only, unless this is the last read
+                    logged_end = len(slapd_output) if started \
+                                     else slapd_output.rfind('\n') + 1
+                    for line in slapd_output[slapd_output_logged_end:
+                                             logged_end].splitlines():
+                        _logging.debug('slapd: ' + line)
+                    slapd_output_logged_end = logged_end
+
+                if started:
+                    slapd_proc.stdout.close()
+                    break
 
-                # CAVEAT: sleep even after seeing ``slapd starting`` because on
-                #     some systems that message is emitted slightly before
-                #     slapd can actually accept connections
-                _sleep(self._START_POLL_PERIOD)
+            # CAVEAT: on some systems ``slapd starting`` is emitted slightly
+            #     before slapd can actually accept connections
+            _sleep(self._START_SETTLE_PERIOD)
 
             if pidfilepath:
                 with open(pidfilepath, 'r') as pidfile:
@@ -274,19 +338,32 @@ class OpenLdapService(_services.ServiceImpl):
     def _start_nofork(self):
         self._start(fork=False)
 
+    _OLC_PIDFILE_RE = _re.compile(r'olcPidFile:\s+(?P<pidfile>.*)$')
+
+    _OUTPUT_READ_SIZE = 4096
+    """The maximum size, in bytes, of each read of the server's output."""
+
     _PASSWORD_WITH_SCHEME_RE = \
         _re.compile(r'^\{(?P<scheme>\w+)\}(?P<value>.*)')
 
     _PIDFILE_STD_DIR = '/var/run'
 
-    _START_POLL_PERIOD = 0.01
+    _START_MESSAGE = 'slapd starting'
+    """The message with which the server reports that it has started."""
+
+    _START_SETTLE_PERIOD = 0.01
     """
-    The period, in seconds, with which to poll the server for whether it has
-    started.
+    The time, in seconds, to wait after the server reports that it has
+    started before considering it ready to accept connections.
 
     """
 
-_services.Service.register_impl('openldap', OpenLdapService)
+    _START_TIMEOUT = 30
+    """
+    The maximum time, in seconds, to wait for the server to report that it
+    has started.
+
+    """
 
 
 def _find_openldap_system_configdir():
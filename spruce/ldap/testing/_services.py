@@ -4,13 +4,26 @@ __copyright__ = "Copyright (C) 2014 Ivan D Vasin"
 __docformat__ = "restructuredtext"
 
 import abc as _abc
+import atexit as _atexit
+from collections import namedtuple as _namedtuple
+from itertools import chain as _chain
+import logging as _logging
+from operator import attrgetter as _attrgetter
 import os as _os
+from pipes import quote as _shquote
+import re as _re
 import shutil as _sh
-from tempfile import mkdtemp as _mkdtemp
+import subprocess as _subprocess
+from tempfile import mkdtemp as _mkdtemp, mkstemp as _mkstemp
+import threading as _threading
 import unittest as _unittest
 
+from ldap import SCOPE_SUBTREE as _SCOPE_SUBTREE
+from ldap.dn import explode_dn as _explode_dn
+import ldif as _ldif
 import spruce.ldap as _ldap
 import spruce.ldap.openldap as _openldap
+from spruce.pprint import indented as _indented
 
 from . import _users as _test_users
 
@@ -38,217 +51,459 @@ class LdapTestService(_ldap.Service):
                  groups=None,
                  access=None,
                  index=('uid eq,pres,sub',),
-                 pidfile=None):
+                 pidfile=None,
+                 dbconfig=None):
 
-        self.__dict__['_impl'] = None
+        # bypass :meth:`Service.__setattr__`, whose delegation checks are
+        # needless for these private attributes
+        attrs = self.__dict__
+        attrs['_impl'] = None
 
         if rootdir is None:
             if configloc is None or dbdir is None or pidfile is None \
                    or uris is None:
                 rootdir = self._create_rootdir()
-        self.__dict__['_rootdir'] = rootdir
-
-        self.__dict__['_domain'] = domain
-        self.__dict__['_suffix'] = suffix if suffix is not None \
-                              else ','.join('dc={}'.format(dc)
-                                            for dc in self.domain.split('.'))
-        self.__dict__['_groups_dn'] = groups_dn if groups_dn is not None \
-                                      else 'ou=groups,{}'.format(self.suffix)
-        self.__dict__['_users_dn'] = users_dn if users_dn is not None \
-                                     else 'ou=users,{}'.format(self.suffix)
-
-        self.__dict__['_access'] = \
-            access if access is not None \
-                   else ('to attrs=userPassword'
-                          ' by self write by anonymous auth by * none',
-                         'to dn.base="" by * read',
-                         'to *'
-                          ' by self write'
-                          ' by group="cn=admins,{}" read'
-                          ' by anonymous auth'
-                          ' by * none'
-                          .format(self.groups_dn))
-        self.__dict__['_authz_map'] = \
-            authz_map if authz_map is not None \
-                      else {r'uid=([^,]*),cn=[^,]*,cn=auth':
-                                'uid=$1,{}'.format(self.users_dn),
-                            (r'uid=([^,]*),cn=[^,]*,cn={},cn=auth'
-                              .format(self.domain)):
-                                'uid=$1,{}'.format(self.users_dn),
-                            }
-        self.__dict__['_config_password'] = config_password
-        configloc = configloc if configloc is not None \
-                              else _os.path.join(self.rootdir, 'slapd.d')
-        self.__dict__['_dbdir'] = dbdir if dbdir is not None \
-                                        else _os.path.join(self.rootdir, 'db')
-        self.__dict__['_dbtype'] = dbtype
-        self.__dict__['_groups'] = groups if groups is not None \
-                                          else _test_users.GROUPS
-        self.__dict__['_index'] = index
-        self.__dict__['_implname'] = implname
-        self.__dict__['_modules'] = modules
-        self.__dict__['_pidfile'] = \
+        attrs['_rootdir'] = rootdir
+
+        attrs['_domain'] = domain
+        defaults = _directory_defaults(domain=domain, suffix=suffix,
+                                       groups_dn=groups_dn, users_dn=users_dn)
+        attrs['_suffix'] = defaults.suffix
+        attrs['_groups_dn'] = defaults.groups_dn
+        attrs['_users_dn'] = defaults.users_dn
+
+        attrs['_access'] = access if access is not None \
+                                  else defaults.access
+        attrs['_authz_map'] = authz_map if authz_map is not None \
+                                        else dict(defaults.authz_map)
+        attrs['_config_password'] = config_password
+        # the directories whose paths are derived here are owned by this
+        # service, so it may clear them
+        owned_dirs = []
+        if configloc is None:
+            configloc = _os.path.join(self.rootdir, 'slapd.d')
+            owned_dirs.append(configloc)
+        if dbdir is None:
+            dbdir = _os.path.join(self.rootdir, 'db')
+            owned_dirs.append(dbdir)
+        attrs['_dbdir'] = dbdir
+        attrs['_dbconfig'] = \
+            dbconfig if dbconfig is not None \
+                     else self._NOSYNC_DBCONFIGS.get(dbtype, ())
+        attrs['_dbtype'] = dbtype
+        attrs['_groups'] = groups if groups is not None \
+                                  else _test_users.GROUPS
+        attrs['_index'] = index
+        attrs['_implname'] = implname
+        attrs['_modules'] = modules
+        attrs['_pidfile'] = \
             pidfile if pidfile is not None \
                     else _os.path.join(self.rootdir, 'slapd.pid')
-        self.__dict__['_root_dn'] = \
-            root_dn if root_dn is not None \
-                    else 'cn=admin,{}'.format(self.suffix)
-        self.__dict__['_root_password'] = root_password
-        self.__dict__['_schemas'] = \
-            schemas if schemas is not None \
-                    else [_os.path.join(_openldap.OPENLDAP_SYSTEM_CONFIG_DIR,
-                                        'schema', schema + '.schema')
-                          for schema in ('core', 'cosine', 'inetorgperson')]
+        attrs['_root_dn'] = root_dn if root_dn is not None \
+                                    else defaults.root_dn
+        attrs['_root_password'] = root_password
+        if schemas is None:
+            if _DEFAULT_SCHEMAS is None:
+                raise RuntimeError('cannot find the default schemas: no'
+                                    ' OpenLDAP system configuration directory'
+                                    ' was found')
+            schemas = _DEFAULT_SCHEMAS
+        attrs['_schemas'] = schemas
         uris = uris if uris is not None \
                     else ('ldapi://{}/'.format(_os.path.join(self.rootdir,
                                                              'ldapi')
                                                 .replace('/', '%2F')),)
-        self.__dict__['_users'] = users if users is not None \
-                                        else _test_users.USERS
-
-        self.create_basic(impl=self.implname,
-                          uris=uris,
-                          configloc=configloc,
-                          schemas=self.schemas,
-                          modules=self.modules,
-                          config_password=self.config_password,
-                          dbtype=self.dbtype,
-                          dbdir=self.dbdir,
-                          suffix=self.suffix,
-                          root_dn=self.root_dn,
-                          root_password=self.root_password,
-                          authz_map=self.authz_map,
-                          access=self.access,
-                          index=self.index,
-                          pidfile=self.pidfile)
-
-        super(LdapTestService, self)\
-         .__init__(impl=self.implname, uris=uris, configloc=configloc,
-                   stop_on_del=True)
-
-        self.start(fork=True)
-        self._setup_users()
-        self.stop()
+        attrs['_users'] = users if users is not None \
+                                else _test_users.USERS
+
+        attrs['_owned_dirs'] = tuple(owned_dirs)
+        attrs['_service_configloc'] = configloc
+        attrs['_service_uris'] = uris
+        attrs['_init_lock'] = _threading.RLock()
 
     def __del__(self):
+        # this is only a backstop for services that were not closed; it may
+        # run during interpreter shutdown, when cleanup can no longer work
+        try:
+            self._destroy_rootdir()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        # the implementation's interface is available only once the service
+        # has been created
+        if not name.startswith('_'):
+            self._ensure_initialized()
+        return super(LdapTestService, self).__getattr__(name)
+
+    def __setattr__(self, name, value):
+        # likewise, so that writes reach the implementation
+        if not name.startswith('_'):
+            self._ensure_initialized()
+        super(LdapTestService, self).__setattr__(name, value)
+
+    @property
+    def authz_map_compiled(self):
+        """The :attr:`authz_map`, with its patterns compiled.
+
+        This is a sequence of (compiled pattern, replacement) pairs, in the
+        order of the map's items.  Like :command:`slapd`, users should
+        :meth:`~re.RegexObject.search` each pattern rather than matching it
+        from the start.  The replacements are as given in the map, so they
+        use :command:`slapd`'s ``$<n>`` group references.
+
+        The patterns are compiled once, on first access.
+
+        """
+        if self._authz_map_compiled is None:
+            try:
+                authz_map_items = self.authz_map.iteritems()
+            except AttributeError:
+                authz_map_items = self.authz_map
+            self.__dict__['_authz_map_compiled'] = \
+                tuple((_re.compile(pattern), replacement)
+                      for pattern, replacement in authz_map_items)
+        return self._authz_map_compiled
+
+    def close(self):
+        """Stop this service, if it is running, and remove its root directory.
+
+        This is done automatically when the service is used as a context
+        manager.  Otherwise it should be called explicitly; without it, the
+        directory is removed only when the service is garbage collected.
+
+        """
+        if self._initialized and self.status == 'running':
+            self.stop()
         self._destroy_rootdir()
 
-    @property
-    def access(self):
-        return self._access
-
-    @property
-    def authz_map(self):
-        return self._authz_map
-
-    @property
-    def config_password(self):
-        return self._config_password
-
-    @property
-    def dbdir(self):
-        return self._dbdir
-
-    @property
-    def dbtype(self):
-        return self._dbtype
-
-    @property
-    def domain(self):
-        return self._domain
-
-    @property
-    def groups(self):
-        return self._groups
-
-    @property
-    def groups_dn(self):
-        return self._groups_dn
-
-    @property
-    def implname(self):
-        return self._implname
-
-    @property
-    def index(self):
-        return self._index
-
-    @property
-    def modules(self):
-        return self._modules
-
-    @property
-    def pidfile(self):
-        return self._pidfile
-
-    @property
-    def root_dn(self):
-        return self._root_dn
-
-    @property
-    def root_password(self):
-        return self._root_password
-
-    @property
-    def rootdir(self):
-        return self._rootdir
-
-    @property
-    def schemas(self):
-        return self._schemas
-
-    @property
-    def suffix(self):
-        return self._suffix
-
-    @property
-    def users(self):
-        return self._users
-
-    @property
-    def users_dn(self):
-        return self._users_dn
+    @classmethod
+    def get_session_instance(cls, domain='example.net', suffix=None,
+                             users=None, groups=None):
+        """A running service that is shared by the whole test session.
+
+        One service is created and started for each distinct combination of
+        arguments, on the first request for it, and it is closed when the
+        interpreter exits.  This spares each test (or test class) the cost
+        of creating, seeding, starting, and stopping a service of its own.
+
+        Since the service's data persists from one user to the next, any
+        user that adds entries should call :meth:`reset_dynamic_entries`
+        when it is done.  Users must not modify or delete the fixture
+        entries.
+
+        :rtype: :class:`LdapTestService`
+
+        """
+        key = (cls, domain, suffix,
+               tuple(users) if users is not None else None,
+               tuple(sorted(groups.items())) if groups is not None else None)
+        return _session_instance(key,
+                                 lambda: cls(domain=domain, suffix=suffix,
+                                             users=users, groups=groups))
+
+    def reset_dynamic_entries(self):
+        """Delete every entry in the suffix except the fixture entries.
+
+        This removes the entries that were added since the service was
+        seeded.  It does not undo changes to the fixture entries themselves.
+
+        The service must be running.
+
+        """
+        baseline_dns = {self.suffix.lower()}
+        for level_entries in self._fixture_entries():
+            baseline_dns.update(dn.lower() for dn, _ in level_entries)
+
+        with self.bound_client(self.root_dn, self.root_password) as ldap:
+            dns_by_depth = {}
+            for dn, _ in ldap.search_s(self.suffix, _SCOPE_SUBTREE,
+                                       attrlist=['1.1']):
+                if dn.lower() not in baseline_dns:
+                    dns_by_depth.setdefault(len(_explode_dn(dn)), [])\
+                                .append(dn)
+
+            # an entry can be deleted only after its children, so the
+            # entries are deleted from the deepest up
+            for depth in sorted(dns_by_depth, reverse=True):
+                msgids = [ldap.delete(dn) for dn in dns_by_depth[depth]]
+                for msgid in msgids:
+                    ldap.result(msgid)
+
+    def start(self, fork=False):
+        if not self._initialized:
+            self._ensure_initialized(keep_running=True)
+            if self.status == 'running':
+                return
+        return self.impl.start(fork=fork)
 
     def _create_rootdir(self):
-        path = _mkdtemp(prefix='ldaptest-slapd-')
-        _os.mkdir(_os.path.join(path, 'db'))
-        _os.mkdir(_os.path.join(path, 'slapd.d'))
+        # a memory-backed filesystem spares the database's disk writes
+        tmpdir = self._TMPFS_DIR
+        if not (_os.path.isdir(tmpdir) and _os.access(tmpdir, _os.W_OK)):
+            tmpdir = None
+        path = _mkdtemp(prefix='ldaptest-slapd-', dir=tmpdir)
+        for subdir in self._ROOTDIR_SUBDIRS:
+            _os.mkdir(_os.path.join(path, subdir))
         return path
 
     def _destroy_rootdir(self):
-        if self.rootdir is not None:
+        if self.rootdir is not None and _os.path.exists(self.rootdir):
             _sh.rmtree(self.rootdir)
 
-    def _setup_users(self):
-
-        ldap = self.client()
-        ldap.simple_bind_s(self.root_dn, self.root_password)
-
-        ldap.add_s(self.users_dn,
-                   (('objectClass', 'organizationalUnit'),
-                    ('ou', 'users')))
-        ldap.add_s(self.groups_dn,
-                   (('objectClass', 'organizationalUnit'),
-                    ('ou', 'groups')))
-
+    def _ensure_initialized(self, keep_running=False):
+        """Create the service and load its fixture entries, if not done yet.
+
+        This is deferred until the service's implementation is first needed,
+        so that merely constructing a :class:`!LdapTestService` does not
+        run :command:`slapd`.
+
+        :param bool keep_running:
+            Whether to leave the service running if it must be started to
+            load the fixture entries.  This is true only for :meth:`start`,
+            which would otherwise start it again right away.
+
+        """
+        if self._initialized:
+            return
+
+        with self._init_lock:
+            # the creation below accesses the implementation's interface,
+            # which reenters this in the same thread
+            if self._initialized or self._creating:
+                return
+
+            if self._creation_error is not None:
+                raise RuntimeError('cannot create LDAP test service: a'
+                                    ' previous attempt failed and left its'
+                                    ' configuration and database'
+                                    ' directories {!r} and {!r} partially'
+                                    ' written: {}'
+                                    .format(self._service_configloc,
+                                            self.dbdir,
+                                            self._creation_error))
+
+            self.__dict__['_creating'] = True
+            try:
+                self.create_basic(impl=self.implname,
+                                  uris=self._service_uris,
+                                  configloc=self._service_configloc,
+                                  schemas=self.schemas,
+                                  modules=self.modules,
+                                  config_password=self.config_password,
+                                  dbtype=self.dbtype,
+                                  dbdir=self.dbdir,
+                                  suffix=self.suffix,
+                                  root_dn=self.root_dn,
+                                  root_password=self.root_password,
+                                  authz_map=self.authz_map,
+                                  access=self.access,
+                                  index=self.index,
+                                  pidfile=self.pidfile,
+                                  dbconfig=self.dbconfig)
+
+                super(LdapTestService, self)\
+                 .__init__(impl=self.implname, uris=self._service_uris,
+                           configloc=self._service_configloc,
+                           stop_on_del=True)
+
+                if not self._setup_users_offline():
+                    self.impl.start(fork=True)
+                    self._setup_users()
+                    if not keep_running:
+                        self.impl.stop()
+
+            except Exception as exc:
+                # a service whose entries were not all loaded must not be
+                # used, so it is discarded
+                impl = self.impl
+                if impl is not None and impl.status == 'running':
+                    try:
+                        impl.stop()
+                    except _ldap.InvalidServiceOperation:
+                        pass
+                self.__dict__['_impl'] = None
+                self.__dict__.pop('_impl_attrs', None)
+
+                # the next attempt needs empty directories; those that this
+                # service does not own are left alone, so it cannot be
+                # created again
+                dirty_dirs = (self._service_configloc, self.dbdir)
+                if all(dir_ in self._owned_dirs for dir_ in dirty_dirs):
+                    for dir_ in dirty_dirs:
+                        if _os.path.exists(dir_):
+                            _sh.rmtree(dir_)
+                        _os.mkdir(dir_)
+                else:
+                    self.__dict__['_creation_error'] = exc
+                raise
+
+            else:
+                self.__dict__['_initialized'] = True
+
+            finally:
+                self.__dict__['_creating'] = False
+
+    def _fixture_entries(self):
+        """The fixture entries, as (DN, modlist) pairs grouped by level.
+
+        Each level's entries are the children of entries in preceding
+        levels, and are independent of each other, so the requests for a
+        level's entries can be pipelined.
+
+        """
+        ou_entries = ((self.users_dn, _USERS_OU_MODLIST),
+                      (self.groups_dn, _GROUPS_OU_MODLIST))
+
+        # each user's DN is built once, then shared by the user's entry and
+        # the member lists of the user's groups
+        users_dn_suffix = ',' + self.users_dn
+        user_dns = {}
+        for user in _chain(self.users, *self.groups.values()):
+            if user.name not in user_dns:
+                user_dns[user.name] = 'uid=' + user.name + users_dn_suffix
+
+        entries = []
         for user in self.users:
-            ldap.add_s('uid={},{}'.format(user.name, self.users_dn),
-                       (('objectClass', 'inetOrgPerson'),
-                        ('uid', user.name),
-                        ('displayName', user.displayname),
-                        ('cn', user.commonname),
-                        ('givenName', user.givenname),
-                        ('sn', user.surname),
-                        ('userPassword', user.password),
-                        ))
-
+            entries.append((user_dns[user.name],
+                            (('objectClass', 'inetOrgPerson'),
+                             ('uid', user.name),
+                             ('displayName', user.displayname),
+                             ('cn', user.commonname),
+                             ('givenName', user.givenname),
+                             ('sn', user.surname),
+                             ('userPassword', user.password),
+                             )))
+        groups_dn_suffix = ',' + self.groups_dn
         for group, group_users in self.groups.items():
-            ldap.add_s('cn={},{}'.format(group, self.groups_dn),
-                       (('objectClass', 'groupOfNames'),
-                        ('cn', group),
-                        ('member',
-                         ['uid={},{}'.format(user.name, self.users_dn)
-                          for user in group_users])))
+            entries.append(('cn=' + group + groups_dn_suffix,
+                            (('objectClass', 'groupOfNames'),
+                             ('cn', group),
+                             ('member',
+                              [user_dns[user.name] for user in group_users]))))
+
+        return ou_entries, entries
+
+    def _setup_users(self):
+        """Add the fixture entries via the running service."""
+        with self.bound_client(self.root_dn, self.root_password) as ldap:
+            for level_entries in self._fixture_entries():
+                msgids = [ldap.add(dn, modlist)
+                          for dn, modlist in level_entries]
+                for msgid in msgids:
+                    ldap.result(msgid)
+
+    def _setup_users_offline(self):
+        """Load the fixture entries directly into the stopped database.
+
+        This uses OpenLDAP's :command:`slapadd`, which bypasses the network,
+        authentication, and access control entirely.
+
+        :return:
+            Whether the entries were loaded.  This is false if
+            :command:`slapadd` is not available, in which case
+            :meth:`_setup_users` must be used instead.
+        :rtype: :obj:`bool`
+
+        """
+        if self.implname != 'openldap':
+            return False
+
+        ldif_fd, ldif_path = _mkstemp(prefix='ldaptest-', suffix='.ldif')
+        try:
+            with _os.fdopen(ldif_fd, 'w') as ldif_file:
+                self._write_fixture_ldif(ldif_file)
+
+            # the fixture entries are known to be consistent, so slapadd's
+            # quick mode is used, which skips its checks
+            slapadd_args = ('slapadd', '-q', '-F', self.configloc, '-b',
+                            self.suffix, '-l', ldif_path)
+            try:
+                _subprocess.check_output(slapadd_args,
+                                         stderr=_subprocess.STDOUT)
+            except OSError as exc:
+                if exc.errno == _os.errno.ENOENT:
+                    return False
+                raise
+            except _subprocess.CalledProcessError as exc:
+                raise RuntimeError('cannot load fixture entries via {!r}:'
+                                    ' slapadd returned exit code {} with'
+                                    ' output\n{}'
+                                    .format(' '.join(_shquote(arg)
+                                                     for arg in slapadd_args),
+                                            exc.returncode,
+                                            _indented(exc.output)))
+        finally:
+            _os.remove(ldif_path)
+
+        return True
+
+    def _write_fixture_ldif(self, file):
+        writer = _ldif.LDIFWriter(file)
+        for level_entries in self._fixture_entries():
+            for dn, modlist in level_entries:
+                entry = {}
+                for attr, value in modlist:
+                    values = entry.setdefault(attr, [])
+                    if isinstance(value, basestring):
+                        values.append(value)
+                    else:
+                        values.extend(value)
+                writer.unparse(dn, entry)
+
+    _authz_map_compiled = None
+
+    _creating = False
+
+    _creation_error = None
+
+    _initialized = False
+
+    _FIELDS = ('access', 'authz_map', 'config_password', 'dbconfig', 'dbdir',
+               'dbtype', 'domain', 'groups', 'groups_dn', 'implname', 'index',
+               'modules', 'pidfile', 'root_dn', 'root_password', 'rootdir',
+               'schemas', 'suffix', 'users', 'users_dn')
+    """
+    The names of this service's configuration fields.
+
+    Each one is exposed as a read-only property whose value is stored in
+    the corresponding underscore-prefixed attribute.
+
+    """
+
+    _NOSYNC_DBCONFIGS = {dbtype: (('olcDbNoSync', 'TRUE'),)
+                         for dbtype in ('bdb', 'hdb', 'mdb')}
+    """The default database settings for each database type.
+
+    For the database types that support it, the default is to skip
+    synchronizing the database to disk after each write.  This sacrifices
+    the database's durability, which a test service does not need, for
+    much faster writes.
+
+    """
+
+    _ROOTDIR_SUBDIRS = ('db', 'slapd.d')
+    """The subdirectories created in a generated root directory."""
+
+    _TMPFS_DIR = '/dev/shm'
+    """The preferred parent of a generated root directory.
+
+    This is a memory-backed filesystem on most Linux systems.  If it is not
+    a writable directory, the system's default temporary directory is used
+    instead.
+
+    """
+
+
+for _field in LdapTestService._FIELDS:
+    setattr(LdapTestService, _field, property(_attrgetter('_' + _field)))
+del _field
 
 
 class LdapServiceTestCase(_unittest.TestCase):
@@ -261,22 +516,17 @@ class LdapServiceTestCase(_unittest.TestCase):
         super(LdapServiceTestCase, self).__init__(*args, **kwargs)
         self._ldapservice = None
 
+    def __getattr__(self, name):
+        # ``ldapservice_<attr>`` is the service's ``<attr>``
+        if name.startswith('ldapservice_'):
+            return getattr(self.ldapservice, name[len('ldapservice_'):])
+        raise AttributeError('{!r} object has no attribute {!r}'
+                              .format(self.__class__.__name__, name))
+
     @property
     def ldapservice(self):
         return self._ldapservice
 
-    @property
-    def ldapservice_configloc(self):
-        return self.ldapservice.configloc
-
-    @property
-    def ldapservice_pid(self):
-        return self.ldapservice.pid
-
-    @property
-    def ldapservice_uris(self):
-        return self.ldapservice.uris
-
     def setUp(self):
         self._setup_ldapservice()
         super(LdapServiceTestCase, self).setUp()
@@ -304,98 +554,188 @@ class LdapServiceTestCase(_unittest.TestCase):
 
 class LdapTestServiceTestCase(LdapServiceTestCase):
 
-    @property
-    def ldapservice_config_password(self):
-        return self.ldapservice.config_password
+    @classmethod
+    def setUpClass(cls):
+        super(LdapTestServiceTestCase, cls).setUpClass()
+        cls._shared_ldapservice = None
 
-    @property
-    def ldapservice_configloc(self):
-        return self.ldapservice.configloc
+    @classmethod
+    def tearDownClass(cls):
+        ldapservice = cls._shared_ldapservice
+        cls._shared_ldapservice = None
+        if ldapservice is not None:
+            ldapservice.close()
+        super(LdapTestServiceTestCase, cls).tearDownClass()
 
-    @property
-    def ldapservice_dbdir(self):
-        return self.ldapservice.dbdir
+    def _create_ldapservice(self):
+        if self.SESSION_SERVICE:
+            # the test classes that share a factory share its service
+            cls = self.__class__
+            return _session_instance((cls._new_ldapservice.im_func,),
+                                     cls._new_ldapservice)
 
-    @property
-    def ldapservice_dbtype(self):
-        return self.ldapservice.dbtype
+        if self.FRESH_SERVICE_PER_TEST:
+            return self._new_ldapservice()
 
-    @property
-    def ldapservice_domain(self):
-        return self.ldapservice.domain
+        cls = self.__class__
+        if cls._shared_ldapservice is None:
+            cls._shared_ldapservice = cls._new_ldapservice()
+        return cls._shared_ldapservice
 
-    @property
-    def ldapservice_groups(self):
-        return self.ldapservice.groups
+    @classmethod
+    def _new_ldapservice(cls):
+        """A new service for these tests.
 
-    @property
-    def ldapservice_groups_dn(self):
-        return self.ldapservice.groups_dn
+        This creates the service shared by a test class, the services
+        created per test if :attr:`FRESH_SERVICE_PER_TEST` is true, and the
+        session service if :attr:`SESSION_SERVICE` is true.  Subclasses can
+        override it to customize the service.
 
-    @property
-    def ldapservice_implname(self):
-        return self.ldapservice.implname
+        :rtype: :class:`LdapTestService`
 
-    @property
-    def ldapservice_index(self):
-        return self.ldapservice.index
+        """
+        return LdapTestService()
 
-    @property
-    def ldapservice_modules(self):
-        return self.ldapservice.modules
+    def _start_ldapservice(self):
+        # the session service is already running
+        if not self.SESSION_SERVICE:
+            self.ldapservice.start(fork=True)
 
-    @property
-    def ldapservice_pidfile(self):
-        return self.ldapservice.pidfile
+    def _teardown_ldapservice(self):
+        if self.SESSION_SERVICE:
+            self.ldapservice.reset_dynamic_entries()
+        elif self.FRESH_SERVICE_PER_TEST:
+            self.ldapservice.close()
+        else:
+            self.ldapservice.stop()
 
-    @property
-    def ldapservice_root_dn(self):
-        return self.ldapservice.root_dn
+    FRESH_SERVICE_PER_TEST = False
+    """Whether each test gets a service of its own.
 
-    @property
-    def ldapservice_root_password(self):
-        return self.ldapservice.root_password
+    By default, the tests in each class share one service, which is created
+    for the first test and destroyed after the last.  The service is started
+    and stopped around each test, but its data persists from one test to the
+    next.  Test classes that modify the service's data should set this to
+    true.
 
-    @property
-    def ldapservice_rootdir(self):
-        return self.ldapservice.rootdir
+    """
 
-    @property
-    def ldapservice_schemas(self):
-        return self.ldapservice.schemas
+    SESSION_SERVICE = False
+    """Whether the tests use the service shared by the whole test session.
 
-    @property
-    def ldapservice_suffix(self):
-        return self.ldapservice.suffix
+    If this is true, then :attr:`FRESH_SERVICE_PER_TEST` is ignored, and
+    the tests use a service that is created by :meth:`_new_ldapservice` on
+    first use and shared with every test class that has the same
+    :meth:`!_new_ldapservice`, until the interpreter exits.  That service
+    is left running between tests, and after each test any entries that it
+    added are deleted via :meth:`LdapTestService.reset_dynamic_entries`.
+    The tests must not modify or delete the fixture entries.
 
-    @property
-    def ldapservice_uris(self):
-        return self.ldapservice.uris
+    """
 
-    @property
-    def ldapservice_users(self):
-        return self.ldapservice.users
+    _shared_ldapservice = None
 
-    @property
-    def ldapservice_users_dn(self):
-        return self.ldapservice.users_dn
 
-    def _create_ldapservice(self):
-        return LdapTestService()
+class LdapExternalServiceTestCase(LdapServiceTestCase):
 
     def _start_ldapservice(self):
-        self.ldapservice.start(fork=True)
+        pass
 
     def _teardown_ldapservice(self):
-        self.ldapservice.stop()
+        pass
 
 
-class LdapExternalServiceTestCase(LdapServiceTestCase):
+_DirectoryDefaults = \
+    _namedtuple('_DirectoryDefaults',
+                ('suffix', 'groups_dn', 'users_dn', 'root_dn', 'access',
+                 'authz_map'))
 
-    __metaclass__ = _abc.ABCMeta
 
-    def _start_ldapservice(self):
-        pass
+def _directory_defaults(domain, suffix=None, groups_dn=None, users_dn=None):
 
-    def _teardown_ldapservice(self):
+    key = (domain, suffix, groups_dn, users_dn)
+    try:
+        return _DIRECTORY_DEFAULTS_CACHE[key]
+    except KeyError:
         pass
+
+    if suffix is None:
+        suffix = ','.join('dc={}'.format(dc) for dc in domain.split('.'))
+    if groups_dn is None:
+        groups_dn = 'ou=groups,{}'.format(suffix)
+    if users_dn is None:
+        users_dn = 'ou=users,{}'.format(suffix)
+
+    access = ('to attrs=userPassword'
+               ' by self write by anonymous auth by * none',
+              'to dn.base="" by * read',
+              'to *'
+               ' by self write'
+               ' by group="cn=admins,{}" read'
+               ' by anonymous auth'
+               ' by * none'
+               .format(groups_dn))
+    authz_map = {r'uid=([^,]*),cn=[^,]*,cn=auth': 'uid=$1,{}'.format(users_dn),
+                 r'uid=([^,]*),cn=[^,]*,cn={},cn=auth'.format(domain):
+                     'uid=$1,{}'.format(users_dn),
+                 }
+
+    defaults = _DirectoryDefaults(suffix=suffix, groups_dn=groups_dn,
+                                  users_dn=users_dn,
+                                  root_dn='cn=admin,{}'.format(suffix),
+                                  access=access, authz_map=authz_map)
+    _DIRECTORY_DEFAULTS_CACHE[key] = defaults
+    return defaults
+
+_DIRECTORY_DEFAULTS_CACHE = {}
+
+
+_GROUPS_OU_MODLIST = (('objectClass', 'organizationalUnit'), ('ou', 'groups'))
+
+_USERS_OU_MODLIST = (('objectClass', 'organizationalUnit'), ('ou', 'users'))
+
+
+def _close_session_instances():
+    with _SESSION_INSTANCES_LOCK:
+        services = _SESSION_INSTANCES.values()
+        _SESSION_INSTANCES.clear()
+    # one service that cannot be closed must not keep the others open
+    for service in services:
+        try:
+            service.close()
+        except Exception:
+            _logging.exception('cannot close session LDAP test service {!r}'
+                               .format(service))
+
+
+def _session_instance(key, create):
+    with _SESSION_INSTANCES_LOCK:
+        service = _SESSION_INSTANCES.get(key)
+        if service is None:
+            # only a service that was created and seeded successfully is
+            # shared
+            service = create()
+            try:
+                service.start(fork=True)
+            except Exception:
+                service.close()
+                raise
+            _SESSION_INSTANCES[key] = service
+        elif service.status != 'running':
+            service.start(fork=True)
+    return service
+
+_SESSION_INSTANCES = {}
+
+_SESSION_INSTANCES_LOCK = _threading.Lock()
+
+_atexit.register(_close_session_instances)
+
+
+if _openldap.OPENLDAP_SYSTEM_CONFIG_DIR is not None:
+    _DEFAULT_SCHEMAS = \
+        tuple(_os.path.join(_openldap.OPENLDAP_SYSTEM_CONFIG_DIR, 'schema',
+                            schema + '.schema')
+              for schema in ('core', 'cosine', 'inetorgperson'))
+else:
+    _DEFAULT_SCHEMAS = None
@@ -22,3 +22,8 @@ USERS = (ALICE, BOB, CAROL)
 
 GROUPS = {'active': (ALICE, BOB), 'admins': (ALICE,), 'analysts': (BOB,),
           'authors': (BOB, CAROL)}
+
+GROUP_NAMES = tuple(sorted(GROUPS))
+
+GROUP_EDGES = tuple((group, user.name) for group in GROUP_NAMES
+                    for user in GROUPS[group])